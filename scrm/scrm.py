@@ -1,10 +1,7 @@
 import os
 import numpy as np
 import heapq
-from skimage.future import graph
-from skimage.future.graph.graph_merge import (_revalidate_node_edges,
-                                              _invalidate_edge,
-                                              _rename_node)
+from numba import njit
 
 
 def scrm(img, labels, dms, mas, mmu):
@@ -19,7 +16,7 @@ def scrm(img, labels, dms, mas, mmu):
     dms : int
       desired mean size of merged regions, in pixels
     mas : int
-      maximum allowed size of merged regions, in pixels
+      maximum allowed size of merged regions, in pixels, at least `mmu`
     mmu : int
       minimum mappable unit, in pixels
 
@@ -27,19 +24,376 @@ def scrm(img, labels, dms, mas, mmu):
     -------
     regions : arr
       array of same shape as image, with each distinct region indicated by
-      increasing integer values
+      increasing integer values, stored as int16 unless there are too many
+      regions to fit. Regions are merged and numbered as
+      `merge_size_constrained` does on the RAG ``rag_mean_color`` builds.
+
+    Notes
+    -----
+    The merge loop runs without holding the GIL, so several images can be
+    segmented concurrently from separate threads.
     """
-    rag = graph.rag_mean_color(img, labels, connectivity=1)
-    regions = merge_size_constrained(labels, rag,
-                                     dms, mas, mmu,
-                                     rag_copy=False, in_place_merge=True,
-                                     merge_func=merge_scrm,
-                                     weight_func=weight_scrm,
-                                     ).astype(np.int16)
+    if mas < mmu:
+        raise ValueError('mas must be at least mmu')
+
+    # number the initial regions 0..N-1 in order of their label, and gather
+    # their size and color into arrays indexed by region
+    _, nodes = np.unique(labels, return_inverse=True)
+    nodes = nodes.reshape(labels.shape)
+    flat = nodes.ravel()
+    area = np.bincount(flat)
+    pixels = img.reshape(flat.size, -1)
+    total_color = np.stack([np.bincount(flat, weights=pixels[:, c],
+                                        minlength=area.size)
+                            for c in range(pixels.shape[1])], axis=1)
+    mean_color = total_color / area[:, np.newaxis]
+    edge_src, edge_dst, order = _region_adjacency(nodes)
+
+    total_area, num_ge_mmu, area_lt_mmu, edge_wt = _setup(
+        area, mean_color, edge_src, edge_dst, mmu)
+    exp_final_num = total_area // dms
+
+    parent = _scrm_loop(area, total_color, mean_color,
+                        edge_src, edge_dst, edge_wt,
+                        dms, mas, mmu,
+                        exp_final_num, num_ge_mmu, area_lt_mmu)
+
+    # number the surviving regions in the order the RAG holds its nodes
+    roots = np.flatnonzero(parent == np.arange(parent.size))
+    dtype = np.int16 if roots.size < 32768 else np.int32
+    region_ix = np.zeros(parent.size, dtype=dtype)
+    region_ix[roots[np.argsort(order[roots])]] = np.arange(roots.size)
+    regions = region_ix[parent][nodes]
 
     return regions
 
 
+def _region_adjacency(nodes):
+    """Find the pairs of regions sharing a border in a labeled array.
+
+    Regions are adjacent when they have pixels next to each other along any
+    axis, as in a RAG built with ``connectivity=1``. Such a RAG scans the
+    pixels in raster order, adding an edge from the region of each pixel to
+    every other region among its neighbors, visited in footprint order. A
+    region becomes a node the first time an edge involves it, and the RAG
+    lists its nodes, and orients its edges, in that order.
+
+    Parameters
+    ----------
+    nodes : ndarray
+        Region of each pixel, numbered 0..N-1.
+
+    Returns
+    -------
+    edge_src, edge_dst : ndarray
+        The two regions of each adjacent pair, with each pair listed once and
+        `edge_src` the region the RAG adds first.
+    order : ndarray
+        Position of each region in the node order of the RAG.
+    """
+    n_nodes = nodes.max() + 1
+    # the footprint lists the lower neighbor along each axis, the pixel
+    # itself, then the higher neighbors in reverse order of axis; the region
+    # of the pixel is added before those of its neighbors
+    step = 2 * nodes.ndim + 2
+    pixel = np.arange(nodes.size).reshape(nodes.shape)
+    first = np.full(n_nodes, np.iinfo(np.int64).max)
+    pairs = []
+    for axis in range(nodes.ndim):
+        head = [slice(None)] * nodes.ndim
+        tail = [slice(None)] * nodes.ndim
+        head[axis] = slice(None, -1)
+        tail[axis] = slice(1, None)
+        a = nodes[tuple(head)].ravel()
+        b = nodes[tuple(tail)].ravel()
+        border = a != b
+        a, b = a[border], b[border]
+        pairs.append(np.minimum(a, b).astype(np.int64) * n_nodes +
+                     np.maximum(a, b))
+
+        pa = pixel[tuple(head)].ravel()[border] * step
+        pb = pixel[tuple(tail)].ravel()[border] * step
+        np.minimum.at(first, np.concatenate([a, b, b, a]),
+                      np.concatenate([pa, pa + 1 + 2 * nodes.ndim - axis,
+                                      pb, pb + 1 + axis]))
+
+    order = np.empty(n_nodes, dtype=np.intp)
+    order[np.argsort(first, kind='stable')] = np.arange(n_nodes)
+
+    pairs = np.unique(np.concatenate(pairs))
+    lo, hi = pairs // n_nodes, pairs % n_nodes
+    swap = order[lo] > order[hi]
+    return np.where(swap, hi, lo), np.where(swap, lo, hi), order
+
+
+@njit(nogil=True, cache=True)
+def _setup(area, mean_color, edge_src, edge_dst, mmu):
+    """Compute the initial state of the merge loop.
+
+    Returns
+    -------
+    total_area : int
+        Total area of the nodes, in pixels.
+    num_ge_mmu : int
+        Number of nodes >= mmu size.
+    area_lt_mmu : int
+        Total area in nodes smaller than mmu size.
+    edge_wt : ndarray
+        Squared distance between the mean colors of the nodes of each edge.
+    """
+    total_area = 0
+    num_ge_mmu = 0
+    area_lt_mmu = 0
+    for n in range(area.shape[0]):
+        a = area[n]
+        total_area += a
+        if a < mmu:
+            area_lt_mmu += a
+        else:
+            num_ge_mmu += 1
+
+    edge_wt = np.empty(edge_src.shape[0])
+    for k in range(edge_src.shape[0]):
+        edge_wt[k] = _weight(mean_color, edge_src[k], edge_dst[k])
+
+    return total_area, num_ge_mmu, area_lt_mmu, edge_wt
+
+
+@njit(nogil=True, cache=True)
+def _scrm_loop(area, total_color, mean_color,
+               edge_src, edge_dst, edge_wt,
+               dms, mas, mmu,
+               exp_final_num, num_ge_mmu, area_lt_mmu):
+    """Compiled main loop of Size-Constrained Region Merging.
+
+    Node attributes are stored as arrays indexed by node, and are updated in
+    place as nodes are merged. Edges are identified by their position in an
+    edge table, which grows as merges create new edges. A min-heap of
+    weights and edge ids, held in two arrays, orders the candidate pairs, and
+    an edge is discarded when popped if either of its nodes has been merged
+    since the edge was pushed. Edges of equal weight are ordered by their
+    nodes, as the ``[weight, src, dst, valid]`` items of a RAG merge are.
+
+    Parameters
+    ----------
+    area : ndarray
+        Pixel count of each node.
+    total_color, mean_color : ndarray
+        Sum and mean of the color of the pixels in each node, one row per node.
+    edge_src, edge_dst : ndarray
+        Nodes joined by each edge of the initial RAG, in the order
+        ``rag.edges`` gives them; `edge_src` is merged into `edge_dst`.
+    edge_wt : ndarray
+        Weight of each edge of the initial RAG, the squared distance between
+        the mean colors of its nodes.
+    dms, mas, mmu : int
+        Desired mean size, maximum allowed size and minimum mappable unit of
+        regions, in pixels.
+    exp_final_num : int
+        Expected number of regions once merging is complete.
+    num_ge_mmu : int
+        Number of regions >= mmu size.
+    area_lt_mmu : int
+        Total area in regions smaller than mmu size.
+
+    Returns
+    -------
+    parent : ndarray
+        The node each node has been merged into, once merging is complete.
+    """
+    n_nodes = area.shape[0]
+    n_edges = edge_src.shape[0]
+
+    # edge table, with each edge in the linked lists of both of its nodes;
+    # slot 2*k links edge k for its src node, slot 2*k + 1 for its dst node
+    capacity = max(2 * n_edges, 16)
+    src_tbl = np.empty(capacity, np.int64)
+    dst_tbl = np.empty(capacity, np.int64)
+    valid = np.zeros(capacity, np.bool_)
+    next_slot = np.empty(2 * capacity, np.int64)
+    head = np.full(n_nodes, -1, np.int64)
+
+    # each edge is pushed once, so the heap fits in arrays as long as the table
+    heap_wt = np.empty(capacity)
+    heap_eid = np.empty(capacity, np.int64)
+    for k in range(n_edges):
+        n1, n2 = edge_src[k], edge_dst[k]
+        src_tbl[k], dst_tbl[k], valid[k] = n1, n2, True
+        next_slot[2 * k], head[n1] = head[n1], 2 * k
+        next_slot[2 * k + 1], head[n2] = head[n2], 2 * k + 1
+        heap_wt[k], heap_eid[k] = edge_wt[k], k
+    heap_len = n_edges
+    for pos in range(heap_len // 2 - 1, -1, -1):
+        _sift_down(heap_wt, heap_eid, heap_len, pos, src_tbl, dst_tbl)
+    num_edges = n_edges
+
+    parent = np.arange(n_nodes)
+    nbrs = np.empty(n_nodes, np.int64)
+    seen = np.full(n_nodes, -1, np.int64)
+
+    partial_stop = False
+    while heap_len > 0:
+        k = _heap_pop(heap_wt, heap_eid, heap_len, src_tbl, dst_tbl)
+        heap_len -= 1
+
+        if ((num_ge_mmu + (area_lt_mmu/dms)) < exp_final_num) and \
+                not partial_stop:
+            partial_stop = True
+
+        if not valid[k]:
+            continue
+
+        n1, n2 = src_tbl[k], dst_tbl[k]
+        n1_area, n2_area = area[n1], area[n2]
+        # as mas >= mmu, this also rules out pairs both exceeding mas
+        if (n1_area > mas and n2_area > mmu) or \
+                (n1_area > mmu and n2_area > mas) or \
+                (partial_stop and n1_area >= mmu and n2_area >= mmu):
+            continue
+
+        # invalidate all edges of `n1` and `n2`, collecting the neighbors of
+        # the merged node
+        num_nbrs = 0
+        for node in (n1, n2):
+            slot = head[node]
+            while slot != -1:
+                e = slot >> 1
+                if valid[e]:
+                    valid[e] = False
+                    nbr = dst_tbl[e] if slot & 1 == 0 else src_tbl[e]
+                    if nbr != n1 and nbr != n2 and seen[nbr] != k:
+                        seen[nbr] = k
+                        nbrs[num_nbrs] = nbr
+                        num_nbrs += 1
+                slot = next_slot[slot]
+            head[node] = -1
+
+        # merge `n1` into `n2`
+        new_area = n1_area + n2_area
+        area[n2] = new_area
+        for c in range(total_color.shape[1]):
+            total_color[n2, c] += total_color[n1, c]
+            mean_color[n2, c] = total_color[n2, c] / new_area
+        parent[n1] = n2
+
+        num_ge_mmu += int(new_area >= mmu) - int(n1_area >= mmu) - \
+            int(n2_area >= mmu)
+        area_lt_mmu += (new_area if new_area < mmu else 0) - \
+            (n1_area if n1_area < mmu else 0) - \
+            (n2_area if n2_area < mmu else 0)
+
+        # push an edge from the merged node to each of its neighbors
+        for i in range(num_nbrs):
+            nbr = nbrs[i]
+            wt = _weight(mean_color, n2, nbr)
+
+            if num_edges == capacity:
+                capacity *= 2
+                src_tbl = _grow(src_tbl, capacity)
+                dst_tbl = _grow(dst_tbl, capacity)
+                valid = _grow(valid, capacity)
+                next_slot = _grow(next_slot, 2 * capacity)
+                heap_wt = _grow(heap_wt, capacity)
+                heap_eid = _grow(heap_eid, capacity)
+            e = num_edges
+            num_edges += 1
+            src_tbl[e], dst_tbl[e], valid[e] = n2, nbr, True
+            next_slot[2 * e], head[n2] = head[n2], 2 * e
+            next_slot[2 * e + 1], head[nbr] = head[nbr], 2 * e + 1
+            _heap_push(heap_wt, heap_eid, heap_len, wt, e, src_tbl, dst_tbl)
+            heap_len += 1
+
+    for n in range(n_nodes):
+        root = n
+        while parent[root] != root:
+            root = parent[root]
+        parent[n] = root
+
+    return parent
+
+
+@njit(nogil=True, cache=True)
+def _weight(mean_color, n1, n2):
+    """Squared distance between the mean colors of nodes `n1` and `n2`."""
+    wt = 0.0
+    for c in range(mean_color.shape[1]):
+        d = mean_color[n1, c] - mean_color[n2, c]
+        wt += d * d
+    return wt
+
+
+@njit(nogil=True, cache=True)
+def _precedes(wt1, e1, wt2, e2, src_tbl, dst_tbl):
+    """Whether edge `e1` of weight `wt1` pops before edge `e2` of `wt2`.
+
+    Edges are ordered by weight, then by their src node, then by their dst
+    node.
+    """
+    if wt1 != wt2:
+        return wt1 < wt2
+    if src_tbl[e1] != src_tbl[e2]:
+        return src_tbl[e1] < src_tbl[e2]
+    return dst_tbl[e1] < dst_tbl[e2]
+
+
+@njit(nogil=True, cache=True)
+def _heap_push(heap_wt, heap_eid, heap_len, wt, eid, src_tbl, dst_tbl):
+    """Push an edge onto a heap of `heap_len` items, with room for one more."""
+    pos = heap_len
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if _precedes(wt, eid, heap_wt[parent], heap_eid[parent],
+                     src_tbl, dst_tbl):
+            heap_wt[pos], heap_eid[pos] = heap_wt[parent], heap_eid[parent]
+            pos = parent
+        else:
+            break
+    heap_wt[pos], heap_eid[pos] = wt, eid
+
+
+@njit(nogil=True, cache=True)
+def _heap_pop(heap_wt, heap_eid, heap_len, src_tbl, dst_tbl):
+    """Remove the smallest item from a heap of `heap_len` items.
+
+    Returns the edge id of the item; the heap then holds `heap_len - 1` items.
+    """
+    eid = heap_eid[0]
+    heap_len -= 1
+    if heap_len > 0:
+        heap_wt[0], heap_eid[0] = heap_wt[heap_len], heap_eid[heap_len]
+        _sift_down(heap_wt, heap_eid, heap_len, 0, src_tbl, dst_tbl)
+    return eid
+
+
+@njit(nogil=True, cache=True)
+def _sift_down(heap_wt, heap_eid, heap_len, pos, src_tbl, dst_tbl):
+    """Move the item at `pos` towards the leaves of the heap."""
+    wt, eid = heap_wt[pos], heap_eid[pos]
+    child = 2 * pos + 1
+    while child < heap_len:
+        right = child + 1
+        if right < heap_len and \
+                _precedes(heap_wt[right], heap_eid[right],
+                          heap_wt[child], heap_eid[child], src_tbl, dst_tbl):
+            child = right
+        if _precedes(heap_wt[child], heap_eid[child], wt, eid,
+                     src_tbl, dst_tbl):
+            heap_wt[pos], heap_eid[pos] = heap_wt[child], heap_eid[child]
+            pos = child
+            child = 2 * pos + 1
+        else:
+            break
+    heap_wt[pos], heap_eid[pos] = wt, eid
+
+
+@njit(nogil=True, cache=True)
+def _grow(arr, size):
+    """Copy `arr` into a new, larger array of length `size`."""
+    out = np.empty(size, arr.dtype)
+    out[:arr.shape[0]] = arr
+    return out
+
+
 def merge_size_constrained(labels, rag, dms, mas, mmu,
                            rag_copy, in_place_merge,
                            merge_func, weight_func):
@@ -55,64 +409,122 @@ def merge_size_constrained(labels, rag, dms, mas, mmu,
         Desired Mean Size of regions, in pixels.
     mas : int
         Maximum Allowed Size of regions, in pixels. Note: Not a hard cap.
+        Must be at least `mmu`.
     mmu : int
         Minimum Mappable Unit, minimum size of regions, in pixels.
     rag_copy : bool
         If set, the RAG copied before modifying.
     in_place_merge : bool
-        If set, the nodes are merged in place. Otherwise, a new node is
-        created for each merge..
+        Must be True, nodes are always merged in place.
     merge_func : callable
         This function is called before merging two nodes. For the RAG `graph`
         while merging `src` and `dst`, it is called as follows
         ``merge_func(graph, src, dst)``.
+        The `'pixel count'`, `'total color'` and `'mean color'` node
+        attributes are moved into arrays indexed by node id, stored under the
+        same keys in `graph.graph`, which is where `merge_func` and
+        `weight_func` should read and update them while merging. They are
+        written back to the surviving nodes once merging is complete. Node
+        ids must be non-negative integers.
     weight_func : callable
         The function to compute the new weights of the nodes adjacent to the
         merged node. This is directly supplied as the argument `weight_func`
-        to `merge_nodes`.
+        to `merge_nodes`. If it is `weight_scrm`, the initial edges are
+        reweighed by the squared distance between the mean colors of their
+        nodes to match it; otherwise their `'weight'` is used as is.
     Returns
     -------
     out : ndarray
-        The new labeled array.
+        The new labeled array, int16 unless there are too many regions to
+        fit.
     """
+    if mas < mmu:
+        raise ValueError('mas must be at least mmu')
+    if not in_place_merge:
+        raise ValueError('only in-place merging is supported')
+
     if rag_copy:
         rag = rag.copy()
 
-    edge_heap = []
-
-    # a couple attributes we'll track to enforce a partial stopping criterion
-    rag.graph.update({
-        'num_ge_mmu': 0,  # number of regions >= mmu size
-        'area_lt_mmu': 0,  # total area in regions smaller than mmu size
-     })
+    return _merge_inplace(labels, rag, dms, mas, mmu, merge_func, weight_func)
 
-    total_area = 0  # total area in regions/image
 
-    for n in rag:
-        area = rag.nodes[n]['pixel count']
-        total_area += area
-        if area < mmu:
-            rag.graph['area_lt_mmu'] += area
-        else:
-            rag.graph['num_ge_mmu'] += 1
+def _merge_inplace(labels, rag, dms, mas, mmu, merge_func, weight_func):
+    """Perform Size-Constrained Region Merging on a RAG, in place.
 
-    exp_final_num = total_area // dms  # expected number of regions
+    Each merge keeps the id of the `dst` node. See `merge_size_constrained`
+    for a description of the parameters and return value.
+    """
+    nodes = rag.nodes
+    adj = rag._adj
+    graph_attr = rag.graph
+
+    # Move the node attributes out of the node dicts, into arrays indexed by
+    # node id which `merge_func` and `weight_func` find in `rag.graph`
+    ids = list(rag)
+    if min(ids) < 0:
+        raise ValueError('RAG node ids must be non-negative')
+    pixel_count = np.zeros(max(ids) + 1, dtype=np.int64)
+    pixel_count[ids] = [nodes[n]['pixel count'] for n in ids]
+    total_color = np.zeros((pixel_count.size,
+                            len(nodes[ids[0]]['total color'])))
+    total_color[ids] = [nodes[n]['total color'] for n in ids]
+    mean_color = np.zeros_like(total_color)
+    mean_color[ids] = [nodes[n]['mean color'] for n in ids]
+
+    # map each label to its initial node, and track the node each node is
+    # merged into
+    label_node = np.zeros(labels.max() + 1, dtype=np.intp)
+    for n in ids:
+        label_node[nodes[n]['labels']] = n
+    parent = np.arange(pixel_count.size)
 
-    for n1, n2, data in rag.edges(data=True):
-        # Push a valid edge in the heap
-        wt = data['weight']
-        heap_item = [wt, n1, n2, True]
-        heapq.heappush(edge_heap, heap_item)
+    # a couple attributes we'll track to enforce a partial stopping criterion
+    area = pixel_count[ids]
+    small = area < mmu
+    num_ge_mmu = np.count_nonzero(~small)  # number of regions >= mmu size
+    area_lt_mmu = area[small].sum()  # total area in regions smaller than mmu
+
+    graph_attr.update({
+        'pixel count': pixel_count,
+        'total color': total_color,
+        'mean color': mean_color,
+        'num_ge_mmu': num_ge_mmu,
+        'area_lt_mmu': area_lt_mmu,
+     })
 
-        # Reference to the heap item in the graph
-        data['heap item'] = heap_item
+    exp_final_num = area.sum() // dms  # expected number of regions
+
+    edges = list(rag.edges(data=True))
+    if weight_func is weight_scrm:
+        # Weigh all edges at once by the squared distance between the mean
+        # colors of their nodes, as `weight_scrm` does for merged nodes
+        eu = np.fromiter((n1 for n1, _, _ in edges), np.intp, len(edges))
+        ev = np.fromiter((n2 for _, n2, _ in edges), np.intp, len(edges))
+        diff = mean_color[eu] - mean_color[ev]
+        wts = np.einsum('ij,ij->i', diff, diff).tolist()
+    else:
+        wts = [data['weight'] for _, _, data in edges]
+
+    # The heap holds (weight, src, dst, edge id) items, so that edges of equal
+    # weight pop in order of their nodes, with the validity of each edge id
+    # kept in a table; each edge in the graph stores its id.
+    # Invalidated items stay in the heap and are dropped as soon as they are
+    # popped, which in Python is cheaper than removing them from the heap.
+    edge_valid = [True] * len(edges)
+    edge_heap = [(wt, n1, n2, eid)
+                 for eid, (wt, (n1, n2, _)) in enumerate(zip(wts, edges))]
+    for (wt, _, _, eid), (_, _, data) in zip(edge_heap, edges):
+        data['weight'] = wt
+        data['eid'] = eid
+    heapq.heapify(edge_heap)
 
     partial_stop = False
     while len(edge_heap) > 0:
-        _, n1, n2, valid = heapq.heappop(edge_heap)
+        _, n1, n2, eid = heapq.heappop(edge_heap)
+        if not edge_valid[eid]:
+            continue
 
-        num_ge_mmu = rag.graph['num_ge_mmu']
-        area_lt_mmu = rag.graph['area_lt_mmu']
         if ((num_ge_mmu + (area_lt_mmu/dms)) < exp_final_num) and \
                 not partial_stop:
             partial_stop = True
@@ -130,51 +542,84 @@ def merge_size_constrained(labels, rag, dms, mas, mmu,
         # Thereafter, the candidate list is restricted only to those pairs
         # where at least one of both regions is smaller than MMU.
 
-        if valid:
-            n1_area = rag.nodes[n1]['pixel count']
-            n2_area = rag.nodes[n2]['pixel count']
-            if n1_area > mas and n2_area > mas:
-                valid = False
-            if n1_area > mas and n2_area > mmu:
-                valid = False
-            if n1_area > mmu and n2_area > mas:
-                valid = False
-            if partial_stop:
-                if n1_area >= mmu and n2_area >= mmu:
-                    valid = False
+        n1_area = pixel_count[n1]
+        n2_area = pixel_count[n2]
+        # as mas >= mmu, this also rules out pairs both exceeding mas
+        valid = not ((n1_area > mas and n2_area > mmu) or
+                     (n1_area > mmu and n2_area > mas) or
+                     (partial_stop and n1_area >= mmu and n2_area >= mmu))
 
         # Ensure popped edge is valid, if not, the edge is discarded
         if valid:
-            # Invalidate all neigbors of `src` before its deleted
-            for nbr in rag.neighbors(n1):
-                _invalidate_edge(rag, n1, nbr)
-
-            for nbr in rag.neighbors(n2):
-                _invalidate_edge(rag, n2, nbr)
-
-            if not in_place_merge:
-                next_id = rag.next_id()
-                _rename_node(rag, n2, next_id)
-                src, dst = n1, next_id
-            else:
-                src, dst = n1, n2
+            # Invalidate the edges of `src` before it is deleted; those of
+            # `dst` are invalidated as they are pushed back once merged
+            for edata in adj[n1].values():
+                edge_valid[edata['eid']] = False
 
+            src, dst = n1, n2
             merge_func(rag, src, dst, mmu)
             new_id = rag.merge_nodes(src, dst, weight_func)
-            _revalidate_node_edges(rag, new_id, edge_heap)
+            parent[src] = new_id
+            _revalidate_inplace(rag, new_id, edge_heap, edge_valid)
+
+            num_ge_mmu = graph_attr['num_ge_mmu']
+            area_lt_mmu = graph_attr['area_lt_mmu']
 
-    label_map = np.arange(labels.max() + 1)
-    for ix, (n, d) in enumerate(rag.nodes(data=True)):
-        for label in d['labels']:
-            label_map[label] = ix
+    # write the attributes of the merged nodes back to the RAG
+    for n, d in nodes.items():
+        d['pixel count'] = int(pixel_count[n])
+        d['total color'] = total_color[n].copy()
+        d['mean color'] = mean_color[n].copy()
+
+    # follow each node to the node it was eventually merged into
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    n_regions = rag.number_of_nodes()
+    dtype = np.int16 if n_regions < 32768 else np.int32
+
+    region_ix = np.zeros(parent.size, dtype=dtype)
+    region_ix[list(rag)] = np.arange(n_regions, dtype=dtype)
+    label_map = region_ix[parent[label_node]]
 
     return label_map[labels]
 
 
+def _revalidate_inplace(rag, node, edge_heap, edge_valid):
+    """Push the edges of a merged node back into the heap with new weights.
+
+    Each edge is invalidated and given a new id in the same pass that pushes
+    it back, so the adjacency of the merged node is only walked once.
+
+    Parameters
+    ----------
+    rag : RAG
+        The Region Adjacency Graph.
+    node : int
+        The id of the merged node.
+    edge_heap : list
+        The heap of ``(weight, src, dst, edge id)`` items.
+    edge_valid : list
+        The validity of each edge id.
+    """
+    for nbr, data in rag._adj[node].items():
+        eid = data.get('eid')
+        if eid is not None:
+            edge_valid[eid] = False
+        eid = len(edge_valid)
+        edge_valid.append(True)
+        data['eid'] = eid
+        heapq.heappush(edge_heap, (data['weight'], node, nbr, eid))
+
+
 def weight_scrm(graph, src, dst, n):
     """Callback to handle merging nodes by recomputing mean color.
 
-    The method expects that the mean color of `dst` is already computed.
+    The method expects that the mean color of `dst` is already computed, in
+    the `'mean color'` array of `graph.graph`.
 
     Parameters
     ----------
@@ -188,12 +633,14 @@ def weight_scrm(graph, src, dst, n):
     Returns
     -------
     data : dict
-        A dictionary with the `"weight"` attribute set as the absolute
-        difference of the mean color between node `dst` and `n`.
+        A dictionary with the `"weight"` attribute set as the squared
+        distance between the mean colors of node `dst` and `n`. Edges are
+        only ever compared to each other, so the square root is not taken.
     """
 
-    diff = graph.nodes[dst]['mean color'] - graph.nodes[n]['mean color']
-    diff = np.linalg.norm(diff)
+    mean_color = graph.graph['mean color']
+    diff = mean_color[dst] - mean_color[n]
+    diff = diff.dot(diff)
 
     return {'weight': diff}
 
@@ -201,7 +648,8 @@ def weight_scrm(graph, src, dst, n):
 def merge_scrm(graph, src, dst, mmu):
     """Callback called before merging two nodes of a mean color distance graph.
 
-    This method computes the mean color of `dst`.
+    This method computes the mean color of `dst`, updating the node attribute
+    arrays in `graph.graph`.
 
     Parameters
     ----------
@@ -210,15 +658,17 @@ def merge_scrm(graph, src, dst, mmu):
     src, dst : int
         The vertices in `graph` to be merged.
     """
-    src_area = graph.nodes[src]['pixel count']
-    dst_area = graph.nodes[dst]['pixel count']
+    pixel_count = graph.graph['pixel count']
+    total_color = graph.graph['total color']
+    mean_color = graph.graph['mean color']
 
-    graph.nodes[dst]['total color'] += graph.nodes[src]['total color']
-    graph.nodes[dst]['pixel count'] += graph.nodes[src]['pixel count']
-    graph.nodes[dst]['mean color'] = graph.nodes[dst]['total color'] /\
-        graph.nodes[dst]['pixel count']
+    src_area = int(pixel_count[src])
+    dst_area = int(pixel_count[dst])
+    new_area = src_area + dst_area
 
-    new_area = graph.nodes[dst]['pixel count']
+    total_color[dst] += total_color[src]
+    pixel_count[dst] = new_area
+    mean_color[dst] = total_color[dst] / new_area
 
     d_num_ge_mmu = (new_area >= mmu) - (src_area >= mmu) - (dst_area >= mmu)
 
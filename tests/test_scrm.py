@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""Tests for `scrm` package."""
+
+import numpy as np
+import pytest
+from skimage import data, segmentation
+from skimage.util import img_as_float
+
+try:
+    from skimage.graph import rag_mean_color
+except ImportError:
+    # scikit-image < 0.20
+    from skimage.future.graph import rag_mean_color
+
+from scrm.scrm import scrm, merge_size_constrained, merge_scrm, weight_scrm
+
+
+@pytest.fixture(params=['uint8', 'float'])
+def image(request):
+    """Small RGB image and its oversegmentation into SLIC superpixels."""
+    img = data.astronaut()[:128, :128]
+    labels = segmentation.slic(img, n_segments=300, compactness=10,
+                               start_label=0)
+    if request.param == 'float':
+        img = img_as_float(img)
+    return img, labels
+
+
+def same_partition(a, b):
+    """Whether two label arrays split the image into the same regions."""
+    pairs = np.unique(np.stack([a.ravel(), b.ravel()]), axis=1)
+    return pairs.shape[1] == len(np.unique(a)) == len(np.unique(b))
+
+
+@pytest.mark.parametrize('dms, mas, mmu', [(400, 1200, 100),
+                                           (50, 200, 20),
+                                           (2000, 5000, 500)])
+def test_scrm_matches_rag_merge(image, dms, mas, mmu):
+    img, labels = image
+    rag = rag_mean_color(img, labels, connectivity=1)
+    expected = merge_size_constrained(labels, rag, dms, mas, mmu,
+                                      rag_copy=False, in_place_merge=True,
+                                      merge_func=merge_scrm,
+                                      weight_func=weight_scrm)
+
+    regions = scrm(img, labels, dms, mas, mmu)
+
+    assert regions.shape == labels.shape
+    assert regions.dtype == np.int16
+    assert same_partition(regions, expected)
+
+
+def test_mas_below_mmu(image):
+    img, labels = image
+    with pytest.raises(ValueError):
+        scrm(img, labels, 400, 50, 100)
+
+
+def test_tied_weights():
+    """Edges of equal weight are merged in order of their nodes."""
+    # a 3x4 grid of 2x2 blocks in two colors, so that most edges tie
+    blocks = np.array([[7, 2, 9, 4],
+                       [0, 11, 5, 8],
+                       [3, 6, 10, 1]])
+    labels = np.kron(blocks, np.ones((2, 2), dtype=int))
+    img = np.zeros(labels.shape + (3,), dtype=np.uint8)
+    img[..., 0] = np.where(labels % 3 == 0, 200, 100)
+    img[..., 1] = 50
+    expected = np.kron(np.array([[0, 0, 1, 1],
+                                 [2, 0, 3, 1],
+                                 [2, 2, 3, 1]]), np.ones((2, 2), dtype=int))
+
+    rag = rag_mean_color(img, labels, connectivity=1)
+    merged = merge_size_constrained(labels, rag, 8, 8, 8,
+                                    rag_copy=False, in_place_merge=True,
+                                    merge_func=merge_scrm,
+                                    weight_func=weight_scrm)
+
+    np.testing.assert_array_equal(merged, expected)
+    np.testing.assert_array_equal(scrm(img, labels, 8, 8, 8), expected)